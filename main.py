@@ -1,13 +1,29 @@
 import os
-import json
 import httpx
+import orjson
+from aiolimiter import AsyncLimiter
 import google.generativeai as genai
 import asyncio
-from fastapi import FastAPI, Request, HTTPException
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from operator import itemgetter
+from fastapi import FastAPI, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, ValidationError
+from typing import Any
 from dotenv import load_dotenv
 import subprocess
 import os
+import time
+import dbm
+import threading
 import base64
+import hashlib
+from datetime import datetime, timezone
 
 # --- Carregando as Configurações do .env ---
 load_dotenv()
@@ -18,8 +34,34 @@ EVOLUTION_API_URL = os.getenv("EVOLUTION_API_URL")
 EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY")
 EVOLUTION_INSTANCE_NAME = os.getenv("EVOLUTION_INSTANCE_NAME")
 TARGET_JID = os.getenv("TARGET_JID")
+MAX_HISTORY_TURNS = int(os.getenv("MAX_HISTORY_TURNS", "40")) # Turnos recentes mantidos ao recortar o histórico
+HISTORY_CACHE_BUFFER = int(os.getenv("HISTORY_CACHE_BUFFER", "20")) # Turnos extras acumulados antes de recortar de novo
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "8000")) # Orçamento (estimado) de tokens do histórico enviado ao Gemini
+HISTORY_CACHE_MAX_CONVERSATIONS = int(os.getenv("HISTORY_CACHE_MAX_CONVERSATIONS", "1000")) # Conversas mantidas em memória (LRU); sem efeito enquanto só TARGET_JID é atendido
+HISTORY_FETCH_CONCURRENCY = int(os.getenv("HISTORY_FETCH_CONCURRENCY", "16")) # Páginas do histórico buscadas em paralelo
+EVOLUTION_MAX_RATE = float(os.getenv("EVOLUTION_MAX_RATE", "9")) # Chamadas por segundo à Evolution API
+DEDUP_MAX_IDS = int(os.getenv("DEDUP_MAX_IDS", "10000")) # IDs de mensagens lembrados para descartar reenvios do webhook
+PIPELINE_CONCURRENCY = int(os.getenv("PIPELINE_CONCURRENCY", "8")) # Máximo de ciclos Gemini/Evolution simultâneos; sem efeito enquanto só TARGET_JID é atendido
+MAX_PENDING_TASKS = int(os.getenv("MAX_PENDING_TASKS", "200")) # Mensagens em processamento acima das quais o webhook recusa novas mensagens (503)
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30")) # Mensagens aceitas por minuto por JID
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10")) # Rajada máxima antes do limite entrar em ação
+HISTORY_STORE_PATH = os.getenv("HISTORY_STORE_PATH", "historico_conversas") # Arquivo (dbm) com o histórico salvo entre reinícios
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "0")) # Segundos que uma resposta ao mesmo texto, no mesmo contexto, é reaproveitada (0 = desligado)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000")) # Respostas mantidas nesse cache (LRU)
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25")) # Segundos que o desligamento espera as mensagens em processamento
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+# --- Configuração de Logs ---
+# Os registros são escritos pela thread do QueueListener, fora do event loop.
+# LOG_LEVEL vale só para o bot: em DEBUG o hpack (HTTP/2) exporia a apikey da Evolution.
+fila_logs = queue.SimpleQueue()
+logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s", handlers=[QueueHandler(fila_logs)])
+ouvinte_logs = QueueListener(fila_logs, logging.StreamHandler())
+log = logging.getLogger(__name__)
+log.setLevel(LOG_LEVEL)
 
 # --- Verificação de Configuração Essencial ---
+# Os erros fatais de inicialização usam print: o processo sai antes de o QueueListener começar a escrever.
 config_vars = [GEMINI_API_KEY, GEMINI_MODEL_NAME, SYSTEM_PROMPT, EVOLUTION_API_URL, EVOLUTION_API_KEY, EVOLUTION_INSTANCE_NAME, TARGET_JID]
 if not all(config_vars):
     print("🚨 ERRO CRÍTICO: Verifique se todas as variáveis de ambiente necessárias estão no seu arquivo .env!")
@@ -32,127 +74,410 @@ try:
         model_name=GEMINI_MODEL_NAME,
         system_instruction=SYSTEM_PROMPT
     )
-    print(f"✅ Modelo Gemini '{GEMINI_MODEL_NAME}' configurado com a persona.")
+    log.info("✅ Modelo Gemini '%s' configurado com a persona.", GEMINI_MODEL_NAME)
 except Exception as e:
     print(f"🚨 ERRO CRÍTICO ao configurar o modelo Gemini: {e}")
     exit()
 
+TARGET_JID_BYTES = TARGET_JID.encode()
+
+# --- Endpoints da Evolution API ---
+# Montados uma única vez no import; são relativos ao base_url do cliente compartilhado.
+URL_FIND_MESSAGES = f"/chat/findMessages/{EVOLUTION_INSTANCE_NAME}"
+URL_SET_PRESENCE = f"/chat/setPresence/{EVOLUTION_INSTANCE_NAME}"
+URL_SEND_TEXT = f"/message/sendText/{EVOLUTION_INSTANCE_NAME}"
+URL_GET_MEDIA_BASE64 = f"/chat/getBase64FromMediaMessage/{EVOLUTION_INSTANCE_NAME}"
+EVOLUTION_HEADERS = {"Content-Type": "application/json", "apikey": EVOLUTION_API_KEY}
+
+# --- Cliente HTTP Compartilhado ---
+# Um único AsyncClient reaproveita as conexões (keep-alive/HTTP2) com a Evolution API
+# em vez de abrir um novo handshake TCP+TLS a cada chamada. É fechado no lifespan do app.
+cliente_http = httpx.AsyncClient(
+    base_url=EVOLUTION_API_URL,
+    headers=EVOLUTION_HEADERS,
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=30),
+    timeout=httpx.Timeout(30.0, connect=5.0)
+)
+
+# Limite de taxa proativo: segura as chamadas antes de a Evolution responder 429,
+# em vez de descobrir o limite pelas falhas.
+LIMITADOR_EVOLUTION = AsyncLimiter(max_rate=EVOLUTION_MAX_RATE, time_period=1)
+
+async def post_evolution(url: str, payload: dict, timeout: float) -> httpx.Response:
+    """Faz um POST na Evolution API pelo cliente compartilhado, respeitando o limite de taxa."""
+    async with LIMITADOR_EVOLUTION:
+        return await cliente_http.post(url, content=orjson.dumps(payload), timeout=timeout)
+
 # --- Funções Auxiliares da API ---
 
-def formatar_historico_para_gemini(mensagens_api: list):
+def extrair_texto(msg: dict) -> str | None:
+    """Extrai o texto de um registro da Evolution (desembrulhando ephemeralMessage); None se não houver."""
+    message_obj = msg.get("message")
+    if not message_obj:
+        return None
+    if "ephemeralMessage" in message_obj:
+        message_obj = message_obj["ephemeralMessage"].get("message")
+        if not message_obj:
+            return None
+    # Caminho rápido: a maioria dos registros de texto vem como extendedTextMessage
+    try:
+        texto = message_obj["extendedTextMessage"]["text"] or message_obj.get("conversation")
+    except (KeyError, TypeError):
+        texto = message_obj.get("conversation")
+    return texto.strip() if texto else None
+
+def timestamp_evolution(valor: Any) -> int:
+    """Converte um messageTimestamp da Evolution (número, string ou Long {low, high} do Baileys); 0 se ausente ou inválido."""
+    if isinstance(valor, dict):
+        try:
+            return (int(valor.get("high") or 0) << 32) | (int(valor.get("low") or 0) & 0xFFFFFFFF)
+        except (TypeError, ValueError):
+            return 0
+    try:
+        return int(valor or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def turno_gemini(role: str, texto: str) -> dict:
+    """Monta um turno de texto no formato de conteúdo do Gemini."""
+    return {'role': role, 'parts': [{'text': texto}]}
+
+def formatar_historico_para_gemini(mensagens_api: list) -> list[dict]:
     """Converte o histórico da API da Evolution para o formato do Gemini."""
-    historico_formatado = []
-    for msg in mensagens_api:
-        message_obj = msg.get("message", {})
-        if "ephemeralMessage" in message_obj:
-            message_obj = message_obj.get("ephemeralMessage", {}).get("message", {})
-        
-        texto = (
-            message_obj.get("extendedTextMessage", {}).get("text") or
-            message_obj.get("conversation", "")
-        ).strip()
+    return [
+        turno_gemini("model" if (msg.get("key") or {}).get("fromMe") else "user", texto)
+        for msg in mensagens_api
+        if (texto := extrair_texto(msg))
+    ]
 
-        if not texto:
-            continue
+PREFIXO_RESUMO = "[Resumo da conversa anterior]: "
 
-        role = "model" if msg.get("key", {}).get("fromMe") else "user"
-        
-        historico_formatado.append({
-            'role': role,
-            'parts': [{'text': texto}]
-        })
-    return historico_formatado
+def estimar_tokens(turnos: list[dict]) -> int:
+    """Estimativa grosseira de tokens: ~4 caracteres por token."""
+    return sum(len(parte.get('text', '')) // 4 for turno in turnos for parte in turno['parts'])
+
+def resumir_turnos(turnos: list[dict], limite_caracteres: int) -> str:
+    """Resume heuristicamente os turnos descartados: o início de cada fala, sem chamar o modelo.
+
+    Um resumo anterior (primeiro turno) é incorporado; se passar do limite, ficam os fatos mais recentes.
+    """
+    fatos = []
+    for turno in turnos:
+        for parte in turno['parts']:
+            texto = parte.get('text', '').strip()
+            if texto.startswith(PREFIXO_RESUMO):
+                fatos.append(texto[len(PREFIXO_RESUMO):])
+            elif texto:
+                autor = "Usuário" if turno['role'] == "user" else "Assistente"
+                fatos.append(f"{autor}: {texto[:200] if turno['role'] == 'user' else texto[:120]}")
+    return "; ".join(fatos)[-limite_caracteres:].lstrip("; ")
+
+def reancorar_historico(historico: list[dict]):
+    """Recorta o histórico em blocos (não a cada turno), mantendo o prefixo estável para o cache do Gemini; o que sai vira um turno de resumo."""
+    limite_tokens = HISTORY_TOKEN_BUDGET * 0.8
+    if len(historico) > MAX_HISTORY_TURNS + HISTORY_CACHE_BUFFER or estimar_tokens(historico) > limite_tokens:
+        corte = max(len(historico) - MAX_HISTORY_TURNS, 0)
+        restante = estimar_tokens(historico[corte:])
+        while corte < len(historico) - 1 and restante > limite_tokens / 2:
+            restante -= estimar_tokens(historico[corte:corte + 1])
+            corte += 1
+        # O contexto enviado ao Gemini deve continuar por um turno do usuário
+        while corte < len(historico) and historico[corte]['role'] != "user":
+            corte += 1
+        # O resumo fica com até 1/4 do limite (~4 caracteres por token): somado aos turnos mantidos
+        # (até metade do limite), continua abaixo do gatilho e o próximo recorte demora a vir
+        resumo = resumir_turnos(historico[:corte], int(limite_tokens / 4) * 4)
+        del historico[:corte]
+        if resumo:
+            historico.insert(0, turno_gemini("user", PREFIXO_RESUMO + resumo))
+    # O contexto enviado ao Gemini deve começar por um turno do usuário
+    inicio = 0
+    while inicio < len(historico) and historico[inicio]['role'] != "user":
+        inicio += 1
+    del historico[:inicio]
+
+def montar_conteudo_gemini(historico: list[dict], partes_mensagem_atual: list) -> list:
+    """Retorna o histórico em cache (já no formato do Gemini) seguido da mensagem atual.
+
+    Sempre cria uma lista nova, então o cache nunca é alterado pela montagem do request.
+    """
+    return [*historico, {'role': 'user', 'parts': partes_mensagem_atual}]
+
+# Limita as páginas do histórico buscadas em paralelo (somando todas as conversas)
+# para respeitar o limite de conexões da Evolution
+SEMAFORO_PAGINAS = asyncio.Semaphore(HISTORY_FETCH_CONCURRENCY)
+
+async def buscar_pagina_historico(remetente_jid: str, numero_pagina: int, desde: int | None = None) -> dict:
+    """Busca uma página do findMessages e retorna o objeto com 'pages' e 'records'.
+
+    Com 'desde' (timestamp Unix), pede só as mensagens a partir desse instante. A Evolution só
+    aplica o filtro com gte e lte juntos, em ISO-8601; quem chama filtra de novo do seu lado.
+    """
+    payload = {
+        "page": numero_pagina,
+        "pageSize": 100, # ou 'offset': 100, dependendo da sua versão da API
+        "where": {
+            "key": {"remoteJid": remetente_jid}
+        }
+    }
+    if desde is not None:
+        payload["where"]["messageTimestamp"] = {
+            "gte": datetime.fromtimestamp(desde, timezone.utc).isoformat(),
+            "lte": datetime.now(timezone.utc).isoformat()
+        }
+    async with SEMAFORO_PAGINAS:
+        response = await post_evolution(URL_FIND_MESSAGES, payload, timeout=60)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+    # A estrutura da resposta pode variar, ajuste se necessário
+    return data.get("messages", data)
 
 # CORRIGIDO E MELHORADO: Função para obter histórico com paginação
-async def obter_historico_conversa(remetente_jid: str):
-    """Busca todo o histórico de mensagens da API da Evolution, lidando com paginação."""
-    url = f"{EVOLUTION_API_URL}/chat/findMessages/{EVOLUTION_INSTANCE_NAME}"
-    headers = {"Content-Type": "application/json", "apikey": EVOLUTION_API_KEY}
-    
-    historico_completo = []
-    pagina_atual = 1
-    total_paginas = 1  # Inicia com 1 para entrar no loop
+async def obter_historico_conversa(remetente_jid: str, completo: bool = False, desde: int | None = None, ignorar_id: str | None = None, antes_de: int | None = None) -> tuple[list[dict], int] | None:
+    """Busca o histórico de mensagens da API da Evolution, lidando com paginação.
 
-    print(f"   -> Iniciando busca do histórico completo de '{remetente_jid}'...")
+    Por padrão para na primeira página quando ela já traz mensagens suficientes para a
+    janela enviada ao Gemini (MAX_HISTORY_TURNS); use completo=True para percorrer todas.
+    Com 'desde', mantém apenas as mensagens com messageTimestamp >= desde. O registro com
+    key.id == ignorar_id (a mensagem sendo respondida agora) fica de fora do histórico, assim
+    como, com 'antes_de', tudo com messageTimestamp >= antes_de (mensagens ainda na fila).
+    Retorna (histórico formatado, maior messageTimestamp incorporado) ou None se a busca falhou.
+    """
+    log.info("Iniciando busca do histórico de '%s'...", remetente_jid)
     
     try:
-        async with httpx.AsyncClient(timeout=60) as client:
-            while pagina_atual <= total_paginas:
-                print(f"     -> Buscando página {pagina_atual}/{total_paginas}...")
-                payload = {
-                    "page": pagina_atual,
-                    "pageSize": 100, # ou 'offset': 100, dependendo da sua versão da API
-                    "where": {
-                        "key": {"remoteJid": remetente_jid}
-                    }
-                }
-                response = await client.post(url, headers=headers, json=payload)
-                response.raise_for_status()
-                data = response.json()
-
-                # A estrutura da resposta pode variar, ajuste se necessário
-                messages_data = data.get("messages", data)
-
-                if pagina_atual == 1:
-                    total_paginas = messages_data.get("pages", 1)
-
-                mensagens_da_pagina = messages_data.get("records", [])
-                historico_completo.extend(mensagens_da_pagina)
-                pagina_atual += 1
-
-        # A API retorna as mais recentes primeiro em cada página, então ordenamos no final
-        historico_ordenado = sorted(historico_completo, key=lambda msg: int(msg.get("messageTimestamp", 0)))
+        # A primeira página informa o total de páginas; as demais são independentes entre si
+        log.info("Buscando página 1...")
+        primeira_pagina = await buscar_pagina_historico(remetente_jid, 1, desde)
+        total_paginas = primeira_pagina.get("pages", 1)
+        historico_completo = list(primeira_pagina.get("records", []))
+
+        # A API devolve as mais recentes primeiro: se a página 1 já cobre a janela, o resto nunca seria usado
+        if not completo and len(historico_completo) >= MAX_HISTORY_TURNS:
+            total_paginas = 1
+
+        if total_paginas > 1:
+            log.info("Buscando páginas 2 a %d em paralelo...", total_paginas)
+            demais_paginas = await asyncio.gather(*[buscar_pagina_historico(remetente_jid, n, desde) for n in range(2, total_paginas + 1)])
+            for messages_data in demais_paginas:
+                historico_completo.extend(messages_data.get("records", []))
+
+        # A API retorna as mais recentes primeiro em cada página, então ordenamos no final,
+        # extraindo o timestamp uma única vez por mensagem (decorate-sort-undecorate)
+        decorados = [(timestamp_evolution(msg.get("messageTimestamp")), msg) for msg in historico_completo]
+        decorados = [
+            (ts, msg) for ts, msg in decorados
+            if (desde is None or ts >= desde)
+            and (antes_de is None or ts < antes_de)
+            and (ignorar_id is None or (msg.get("key") or {}).get("id") != ignorar_id)
+        ]
+        ultimo_timestamp_visto = max((ts for ts, _ in decorados), default=0)
+        decorados.sort(key=itemgetter(0))
+        historico_ordenado = [msg for _, msg in decorados]
         
-        print(f"   -> {len(historico_ordenado)} mensagens recuperadas e formatadas.")
-        return formatar_historico_para_gemini(historico_ordenado)
+        log.info("%d mensagens recuperadas e formatadas.", len(historico_ordenado))
+        return formatar_historico_para_gemini(historico_ordenado), ultimo_timestamp_visto
 
+    except httpx.HTTPStatusError as e:
+        log.error("🚨 Erro ao buscar histórico da API: %s", e)
+        log.error("Status Code: %s - Resposta do Erro: %s", e.response.status_code, e.response.text)
+        return None
     except httpx.RequestError as e:
-        print(f"   🚨 Erro ao buscar histórico da API: {e}")
-        return []
+        log.error("🚨 Erro ao buscar histórico da API: %s", e)
+        return None
+    except orjson.JSONDecodeError as e:
+        log.error("🚨 Resposta do histórico não é um JSON válido: %s", e)
+        return None
+
+# --- Persistência do Histórico ---
+# Cada janela vai para um dbm (em JSON) com o maior messageTimestamp já incorporado,
+# para que após um reinício só se busque o que veio depois. O dbm não é thread-safe: tudo passa pela trava.
+trava_armazenamento = threading.Lock()
+
+def _ler_historico_salvo(remetente_jid: str) -> bytes | None:
+    with trava_armazenamento, dbm.open(HISTORY_STORE_PATH, "c") as armazenamento:
+        return armazenamento.get(remetente_jid)
+
+def _gravar_historico(remetente_jid: str, registro: bytes):
+    with trava_armazenamento, dbm.open(HISTORY_STORE_PATH, "c") as armazenamento:
+        armazenamento[remetente_jid] = registro
+
+async def carregar_historico_salvo(remetente_jid: str) -> dict | None:
+    """Lê do disco a última janela salva da conversa ({'turnos', 'sincronizado_em'}), se houver."""
+    try:
+        registro = await asyncio.to_thread(_ler_historico_salvo, remetente_jid)
+        return orjson.loads(registro) if registro else None
+    except Exception as e:
+        log.warning("⚠️ Não foi possível ler o histórico salvo de '%s': %s", remetente_jid, e)
+        return None
+
+async def salvar_historico(remetente_jid: str, historico: list[dict], sincronizado_em: int):
+    """Grava a janela atual da conversa, marcando até qual messageTimestamp ela está sincronizada."""
+    # Serializa aqui, no event loop, para a thread não ler a lista enquanto ela é alterada
+    registro = orjson.dumps({"turnos": historico, "sincronizado_em": sincronizado_em})
+    try:
+        await asyncio.to_thread(_gravar_historico, remetente_jid, registro)
+    except Exception as e:
+        log.warning("⚠️ Não foi possível salvar o histórico de '%s': %s", remetente_jid, e)
+
+# --- Cache de Histórico por Conversa ---
+# O histórico só é buscado na Evolution na primeira mensagem de cada JID; depois os turnos são anexados aqui (LRU).
+# ultimo_timestamp guarda o maior messageTimestamp já incorporado a cada conversa em cache.
+cache_historico: OrderedDict[str, list[dict]] = OrderedDict()
+ultimo_timestamp: dict[str, int] = {}
+travas_conversa: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+async def obter_historico_em_cache(remetente_jid: str, message_id_atual: str | None = None, timestamp_atual: int = 0) -> list[dict]:
+    """Retorna o histórico formatado da conversa, buscando na Evolution apenas se ainda não estiver em cache.
+
+    Se a conversa tiver sido salva em disco, busca só as mensagens chegadas depois da gravação.
+    A mensagem atual (message_id_atual) já consta no findMessages, mas é enviada e anexada à
+    parte pelo processar_mensagem, então é descartada da busca para não entrar duplicada; o mesmo
+    vale para o que chegou a partir de timestamp_atual, que ainda aguarda a vez na trava.
+    Deve ser chamada com travas_conversa[remetente_jid] adquirida.
+    """
+    historico = cache_historico.get(remetente_jid)
+    if historico is None:
+        salvo = await carregar_historico_salvo(remetente_jid)
+        sincronizado_em = salvo["sincronizado_em"] if salvo else 0
+        # +1: a mensagem com o timestamp da gravação já está na janela salva
+        busca = await obter_historico_conversa(
+            remetente_jid, desde=sincronizado_em + 1 if salvo else None,
+            ignorar_id=message_id_atual, antes_de=timestamp_atual or None
+        )
+        novos, ultimo_visto = busca or ([], 0)
+        historico = (salvo["turnos"] if salvo else []) + novos
+        reancorar_historico(historico)
+        # Se a busca falhou não guardamos nada, para tentar de novo na próxima mensagem
+        if busca is not None:
+            cache_historico[remetente_jid] = historico
+            ultimo_timestamp[remetente_jid] = max(sincronizado_em, ultimo_visto)
+            if len(cache_historico) > HISTORY_CACHE_MAX_CONVERSATIONS:
+                jid_descartado, _ = cache_historico.popitem(last=False)
+                ultimo_timestamp.pop(jid_descartado, None)
+    else:
+        cache_historico.move_to_end(remetente_jid)
+        log.info("Histórico de '%s' obtido do cache (%d turnos).", remetente_jid, len(historico))
+    return historico
 
 async def enviar_presenca(remetente_jid: str, tipo_presenca: str):
     """Envia uma notificação de presença (digitando ou pausado)."""
-    url = f"{EVOLUTION_API_URL}/chat/setPresence/{EVOLUTION_INSTANCE_NAME}"
-    headers = {"Content-Type": "application/json", "apikey": EVOLUTION_API_KEY}
     payload = {"number": remetente_jid, "presence": tipo_presenca}
     
     try:
-        async with httpx.AsyncClient() as client:
-            await client.post(url, headers=headers, json=payload, timeout=10)
-        print(f"   -> Presença '{tipo_presenca}' enviada para {remetente_jid}.")
+        await post_evolution(URL_SET_PRESENCE, payload, timeout=10)
+        log.info("Presença '%s' enviada para %s.", tipo_presenca, remetente_jid)
     except httpx.RequestError as e:
-        print(f"   🚨 Erro ao enviar presença: {e}")
+        log.error("🚨 Erro ao enviar presença: %s", e)
+
+async def enviar_resposta_whatsapp(remetente_jid: str, texto_resposta: str, segundos_ja_digitados: float = 0) -> dict | None:
+    """Envia a resposta gerada de volta para o usuário.
 
-async def enviar_resposta_whatsapp(remetente_jid: str, texto_resposta: str):
-    """Envia a resposta gerada de volta para o usuário."""
-    url = f"{EVOLUTION_API_URL}/message/sendText/{EVOLUTION_INSTANCE_NAME}"
-    headers = {"Content-Type": "application/json", "apikey": EVOLUTION_API_KEY}
+    A "digitação" é simulada pela própria Evolution: o delay (em ms) cresce com o tamanho
+    do texto, entre 2 e 8 segundos, descontado o tempo que a geração já levou (segundos_ja_digitados).
+    Retorna o corpo devolvido pela Evolution (a mensagem enviada) ou None se o envio falhou.
+    """
     payload = {
         "number": remetente_jid,
         "text": texto_resposta,
         "options": {
-            "delay": 1200,
+            "delay": int(max(min(max(len(texto_resposta) * 60, 2000), 8000) - segundos_ja_digitados * 1000, 0)),
             "presence": "composing"
         }
     }
     
-    print(f"   -> Enviando resposta para {remetente_jid}...")
+    log.info("Enviando resposta para %s...", remetente_jid)
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload, timeout=30)
-            response.raise_for_status()
-        print("   -> Resposta enviada com sucesso!")
+        response = await post_evolution(URL_SEND_TEXT, payload, timeout=30)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        log.error("🚨 Erro ao enviar resposta via Evolution API: %s", e)
+        log.error("Status Code: %s", e.response.status_code)
+        try:
+            log.error("Resposta do Erro: %s", orjson.loads(e.response.content))
+        except orjson.JSONDecodeError:
+            log.error("Resposta do Erro (não-JSON): %s", e.response.text)
+        return None
     except httpx.RequestError as e:
-        print(f"   🚨 Erro ao enviar resposta via Evolution API: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"   -> Status Code: {e.response.status_code}")
-            try:
-                print(f"   -> Resposta do Erro: {e.response.json()}")
-            except json.JSONDecodeError:
-                print(f"   -> Resposta do Erro (não-JSON): {e.response.text}")
+        log.error("🚨 Erro ao enviar resposta via Evolution API: %s", e)
+        return None
+    log.info("Resposta enviada com sucesso!")
+    try:
+        dados = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        return {}
+    if not isinstance(dados, dict):
+        return {}
+    id_enviado = (dados.get("key") or {}).get("id")
+    if id_enviado:
+        registrar_envio_do_bot(id_enviado)
+    return dados
+
+async def obter_audio_decifrado(message_id: str) -> bytes:
+    """Baixa da Evolution o áudio já decifrado de uma mensagem e retorna seus bytes."""
+    log.info("Buscando áudio decifrado para a mensagem ID: %s...", message_id)
+    payload_get_media = {"message": {"key": {"id": message_id}}}
+    response = await post_evolution(URL_GET_MEDIA_BASE64, payload_get_media, timeout=60)
+    response.raise_for_status()
+    media_response = orjson.loads(response.content)
+
+    base64_audio = media_response.get("base64") 
+    if not base64_audio: raise ValueError("A resposta da API de mídia não continha a chave 'base64'.")
+    audio_data = base64.b64decode(base64_audio)
+    if not audio_data: raise ValueError("O áudio decifrado veio vazio.")
+    log.info("Áudio decifrado com sucesso (%d bytes).", len(audio_data))
+    return audio_data
+
+# --- Modelos do Payload do Webhook ---
+# Só os campos que o bot usa; o restante do payload da Evolution é ignorado.
+class UpsertKey(BaseModel):
+    remoteJid: str
+    fromMe: bool = False
+    id: str | None = None
+
+class ExtendedTextMessage(BaseModel):
+    text: str | None = None
+
+class UpsertMessage(BaseModel):
+    conversation: str | None = None
+    extendedTextMessage: ExtendedTextMessage | None = None
+    audioMessage: dict | None = None
+    ephemeralMessage: "EphemeralMessage | None" = None
+
+class EphemeralMessage(BaseModel):
+    message: UpsertMessage | None = None
+
+UpsertMessage.model_rebuild()
+
+class UpsertData(BaseModel):
+    key: UpsertKey
+    message: UpsertMessage | None = None
+    messageTimestamp: Any = None # Só uma dica para a marca de sincronização; convertido por timestamp_evolution
+
+class EventoWebhook(BaseModel):
+    # 'data' só é validado como UpsertData depois de confirmar que o evento é messages.upsert
+    event: str | None = None
+    data: Any = None
 
 # --- Aplicação FastAPI ---
-app = FastAPI(title="Chatbot WhatsApp com Gemini (com Áudio)")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    ouvinte_logs.start()
+    yield
+    # As mensagens já foram confirmadas ao webhook: espera os ciclos em andamento antes de fechar o cliente
+    tarefas = tarefas_em_andamento | tarefas_registro_turnos
+    if tarefas:
+        log.info("Aguardando %d tarefas em andamento antes de desligar...", len(tarefas))
+        _, pendentes = await asyncio.wait(tarefas, timeout=SHUTDOWN_TIMEOUT)
+        if pendentes:
+            log.error("🚨 %d tarefas ainda em andamento após %.0fs; serão canceladas no desligamento.", len(pendentes), SHUTDOWN_TIMEOUT)
+    await cliente_http.aclose()
+    ouvinte_logs.stop()
+
+# Sem default_response_class=ORJSONResponse: as versões atuais do FastAPI o marcam como obsoleto
+# (com aviso a cada request), e as respostas aqui são dicts minúsculos. O orjson fica no parse.
+app = FastAPI(title="Chatbot WhatsApp com Gemini (com Áudio)", lifespan=lifespan)
 
 @app.get("/health")
 def health_check():
@@ -160,115 +485,318 @@ def health_check():
 
 @app.post("/connection-update")
 async def webhook_connection_update(request: Request):
-    data = await request.json()
+    data = orjson.loads(await request.body())
+    log.debug("Evento recebido em /connection-update: %s", data)
     instance = data.get("instance")
     state = data.get("data", {}).get("state")
-    print(f"✅ Evento de conexão recebido da instância '{instance}': {state}")
+    log.info("✅ Evento de conexão recebido da instância '%s': %s", instance, state)
     return {"status": "connection_update_received"}
 
+# --- Limite de Taxa na Entrada ---
+class TokenBucket:
+    """Balde de tokens: permite rajadas de até `capacidade` e repõe `taxa` tokens por segundo."""
+
+    def __init__(self, capacidade: float, taxa: float):
+        self.capacidade = capacidade
+        self.taxa = taxa
+        self.tokens = capacidade
+        self.ultima_reposicao = time.monotonic()
+
+    def consumir(self) -> bool:
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.ultima_reposicao) * self.taxa)
+        self.ultima_reposicao = agora
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# Um balde por JID, consultado antes de qualquer trabalho downstream ser agendado
+baldes_por_jid: dict[str, TokenBucket] = {}
+
+def dentro_do_limite(remetente_jid: str) -> bool:
+    balde = baldes_por_jid.get(remetente_jid)
+    if balde is None:
+        balde = baldes_por_jid[remetente_jid] = TokenBucket(RATE_LIMIT_BURST, RATE_LIMIT_PER_MINUTE / 60)
+    return balde.consumir()
+
+# --- Deduplicação de Webhooks ---
+# A Evolution reenvia entregas que considera falhas; guardamos os últimos IDs de
+# mensagem (LRU limitado) para não gerar uma segunda resposta para a mesma mensagem.
+ids_recebidos: OrderedDict[str, None] = OrderedDict()
+
+def mensagem_ja_recebida(message_id: str) -> bool:
+    """Retorna True se o ID já foi visto; caso contrário, registra-o."""
+    if message_id in ids_recebidos:
+        ids_recebidos.move_to_end(message_id)
+        return True
+    ids_recebidos[message_id] = None
+    if len(ids_recebidos) > DEDUP_MAX_IDS:
+        ids_recebidos.popitem(last=False)
+    return False
+
+# Mensagens enviadas pelo próprio bot: os ecos fromMe delas no webhook não são respostas manuais
+ids_enviados_pelo_bot: OrderedDict[str, None] = OrderedDict()
+
+def registrar_envio_do_bot(message_id: str):
+    ids_enviados_pelo_bot[message_id] = None
+    if len(ids_enviados_pelo_bot) > DEDUP_MAX_IDS:
+        ids_enviados_pelo_bot.popitem(last=False)
+
+# --- Cache de Respostas ---
+# Opcional (RESPONSE_CACHE_TTL > 0): o mesmo texto em resposta à mesma última fala do bot
+# recebe a mesma resposta sem chamar o Gemini. Um "sim" após perguntas diferentes não colide.
+cache_respostas: OrderedDict[bytes, tuple[float, str]] = OrderedDict()
+
+def chave_resposta(texto: str, historico: list[dict]) -> bytes:
+    """Chave do cache: o texto recebido junto com o último turno do modelo na conversa."""
+    ultimo_turno_modelo = next((turno for turno in reversed(historico) if turno['role'] == "model"), None)
+    contexto = ultimo_turno_modelo['parts'][0].get('text', '') if ultimo_turno_modelo else ''
+    return hashlib.blake2b(orjson.dumps([texto.casefold(), contexto]), digest_size=16).digest()
+
+def resposta_em_cache(texto: str, historico: list[dict]) -> str | None:
+    """Retorna a resposta guardada para esse texto nesse contexto, se o cache estiver ligado e ela não tiver expirado."""
+    if RESPONSE_CACHE_TTL <= 0:
+        return None
+    chave = chave_resposta(texto, historico)
+    entrada = cache_respostas.get(chave)
+    if entrada is None:
+        return None
+    expira_em, resposta = entrada
+    if expira_em < time.monotonic():
+        del cache_respostas[chave]
+        return None
+    cache_respostas.move_to_end(chave)
+    return resposta
+
+def guardar_resposta(texto: str, historico: list[dict], resposta: str):
+    if RESPONSE_CACHE_TTL <= 0:
+        return
+    cache_respostas[chave_resposta(texto, historico)] = (time.monotonic() + RESPONSE_CACHE_TTL, resposta)
+    if len(cache_respostas) > RESPONSE_CACHE_MAX_ENTRIES:
+        cache_respostas.popitem(last=False)
+
+# --- Processamento em Segundo Plano ---
+# Referências fortes às tarefas (o asyncio só guarda fracas), separadas por tipo
+# para que um não consuma o limite (MAX_PENDING_TASKS) do outro. tarefas_registro_turnos
+# só anexam turnos ao histórico (respostas manuais e mensagens acima do limite de taxa).
+tarefas_em_andamento: set[asyncio.Task] = set()
+tarefas_registro_turnos: set[asyncio.Task] = set()
+tarefas_presenca: set[asyncio.Task] = set()
+
+# Limita quantos ciclos rodam ao mesmo tempo; o excedente aguarda na fila do semáforo.
+# O FFmpeg é CPU-bound, então tem um limite próprio atrelado ao número de núcleos.
+# Com um único JID atendido (TARGET_JID) a trava da conversa já serializa os ciclos e nenhum dos dois chega a limitar.
+SEMAFORO_PIPELINE = asyncio.BoundedSemaphore(PIPELINE_CONCURRENCY)
+SEMAFORO_FFMPEG = asyncio.BoundedSemaphore(os.cpu_count() or 1)
+
+async def converter_audio_para_mp3(audio_data: bytes) -> bytes:
+    """Converte o áudio recebido para MP3 passando os bytes pelo stdin/stdout do FFmpeg, sem arquivos temporários."""
+    comando_ffmpeg = ["ffmpeg", "-y", "-i", "pipe:0", "-f", "mp3", "-acodec", "libmp3lame", "-b:a", "128k", "pipe:1"]
+    async with SEMAFORO_FFMPEG:
+        proc = await asyncio.create_subprocess_exec(
+            *comando_ffmpeg,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        mp3_audio_data, stderr = await proc.communicate(input=audio_data)
+    if proc.returncode: raise subprocess.CalledProcessError(proc.returncode, comando_ffmpeg, stderr=stderr)
+    return mp3_audio_data
+
+async def montar_partes_mensagem(message_id: str | None, texto_recebido: str | None) -> list | None:
+    """Monta as partes da mensagem atual do usuário (texto ou áudio); None se o áudio não pôde ser convertido."""
+    if texto_recebido is not None:
+        return [{'text': texto_recebido}]
+
+    audio_data = await obter_audio_decifrado(message_id)
+
+    # Converter para MP3 com FFmpeg
+    log.info("Convertendo áudio para .mp3 usando FFmpeg...")
+    mp3_audio_data = await converter_audio_para_mp3(audio_data)
+    log.info("Conversão para .mp3 concluída.")
+
+    if not mp3_audio_data:
+        return None
+
+    # Adiciona o áudio e um prompt de contexto para o Gemini
+    return [
+        {'text': "Por favor, ouça este áudio e responda de acordo:"},
+        {"mime_type": "audio/mp3", "data": mp3_audio_data},
+    ]
+
+async def processar_mensagem(remetente_jid: str, message_id: str | None, texto_recebido: str | None = None, timestamp_mensagem: Any = None):
+    """Executa o ciclo completo (histórico, áudio, Gemini e resposta) fora do request do webhook.
+
+    Sem texto_recebido, a mensagem é tratada como áudio e baixada pelo message_id.
+
+    O ciclo de cada conversa roda sob a trava do JID: mensagens em rajada do mesmo usuário são
+    respondidas uma de cada vez, na ordem de chegada, e cada uma já vê os turnos da anterior.
+    """
+    tarefa_partes = None
+    # A trava vem antes do semáforo: mensagens na fila do mesmo JID não ocupam vagas do pipeline.
+    # O aviso de erro também sai sob a trava, para o eco fromMe dele já estar registrado como do bot.
+    async with travas_conversa[remetente_jid]:
+        try:
+            async with SEMAFORO_PIPELINE:
+                # O download/conversão do áudio não depende do histórico: roda em paralelo com a busca dele.
+                # Só começa dentro do semáforo, para que mensagens na fila não baixem (e segurem) o áudio antes da vez.
+                tarefa_partes = asyncio.create_task(montar_partes_mensagem(message_id, texto_recebido))
+                historico_conversa = await obter_historico_em_cache(remetente_jid, message_id, timestamp_evolution(timestamp_mensagem))
+                partes_mensagem_atual = await tarefa_partes
+
+                if partes_mensagem_atual is None:
+                    await enviar_resposta_whatsapp(remetente_jid, "Desculpe, não consegui processar seu áudio desta vez.")
+                    return
+
+                inicio_digitacao = time.monotonic()
+                texto_resposta = resposta_em_cache(texto_recebido, historico_conversa) if texto_recebido is not None else None
+                if texto_resposta is not None:
+                    log.info("Resposta obtida do cache de respostas: %s", texto_resposta)
+                else:
+                    # Monta o contexto: histórico + mensagem atual (texto ou áudio)
+                    conteudo_para_gemini = montar_conteudo_gemini(historico_conversa, partes_mensagem_atual)
+
+                    # O indicador de digitação sai junto com a chamada ao Gemini (sem aguardar), não depois dela
+                    tarefa_presenca = asyncio.create_task(enviar_presenca(remetente_jid, "composing"))
+                    tarefas_presenca.add(tarefa_presenca)
+                    tarefa_presenca.add_done_callback(tarefas_presenca.discard)
+                    log.info("Enviando contexto para o Gemini gerar resposta...")
+                    resposta_gemini = await model.generate_content_async(conteudo_para_gemini)
+                    texto_resposta = resposta_gemini.text
+                    log.info("Resposta do Gemini: %s", texto_resposta)
+                    if texto_recebido is not None:
+                        guardar_resposta(texto_recebido, historico_conversa, texto_resposta)
+
+                # A simulação de digitação fica com a Evolution (options.delay/presence do sendText);
+                # o tempo que o Gemini levou já conta como digitação
+                enviada = await enviar_resposta_whatsapp(remetente_jid, texto_resposta, time.monotonic() - inicio_digitacao)
+                if enviada is None:
+                    # O usuário não recebeu a resposta: não entra no histórico, que segue igual ao do WhatsApp
+                    return
+
+                # Registra o novo par de turnos no cache; o áudio em si não é guardado, só um marcador
+                historico_conversa.append(turno_gemini("user", texto_recebido if texto_recebido is not None else "[Mensagem de áudio]"))
+                historico_conversa.append(turno_gemini("model", texto_resposta))
+                reancorar_historico(historico_conversa)
+                # Só persiste janelas sincronizadas com a Evolution (a busca inicial não falhou);
+                # a marca avança até a mensagem recebida e a resposta enviada, pelo relógio do WhatsApp
+                if remetente_jid in ultimo_timestamp:
+                    ultimo_timestamp[remetente_jid] = max(ultimo_timestamp[remetente_jid], timestamp_evolution(timestamp_mensagem), timestamp_evolution(enviada.get("messageTimestamp")))
+                    await salvar_historico(remetente_jid, historico_conversa, ultimo_timestamp[remetente_jid])
+
+        except Exception as e:
+            if tarefa_partes is not None:
+                tarefa_partes.cancel()
+                # Se ela já tinha falhado, o cancel() não faz nada: recupera a exceção para o asyncio não reclamar dela
+                if tarefa_partes.done() and not tarefa_partes.cancelled():
+                    tarefa_partes.exception()
+            # Não há mais request HTTP para devolver o erro; registra e avisa o usuário.
+            log.error("🚨 Erro no ciclo do chatbot: %s", e)
+            try:
+                await enviar_resposta_whatsapp(remetente_jid, "Ocorreu um erro interno e não pude processar sua mensagem.")
+            except: pass
+
+async def anexar_turno(remetente_jid: str, historico_conversa: list[dict], role: str, texto: str, timestamp_mensagem: Any):
+    """Anexa um turno recebido fora do ciclo do bot e persiste a janela. Deve ser chamada com a trava do JID."""
+    historico_conversa.append(turno_gemini(role, texto))
+    reancorar_historico(historico_conversa)
+    ultimo_timestamp[remetente_jid] = max(ultimo_timestamp[remetente_jid], timestamp_evolution(timestamp_mensagem))
+    await salvar_historico(remetente_jid, historico_conversa, ultimo_timestamp[remetente_jid])
+
+async def registrar_resposta_manual(remetente_jid: str, message_id: str, texto: str, timestamp_mensagem: Any = None):
+    """Anexa como turno 'model' uma resposta digitada à mão pelo dono da conta no celular.
+
+    Conversas fora do cache não são tocadas: a próxima busca na Evolution já traz a mensagem
+    (ela fica acima da marca salva, que só avança aqui ou nas respostas do bot).
+    """
+    # Sob a trava do JID: se o eco for de um envio do bot em andamento, o id já estará registrado
+    async with travas_conversa[remetente_jid]:
+        if message_id in ids_enviados_pelo_bot or remetente_jid not in ultimo_timestamp:
+            return
+        historico_conversa = cache_historico.get(remetente_jid)
+        if historico_conversa is None:
+            return
+        log.info("Resposta manual registrada no histórico de %s: %s", remetente_jid, texto)
+        await anexar_turno(remetente_jid, historico_conversa, "model", texto, timestamp_mensagem)
+
+async def registrar_mensagem_limitada(remetente_jid: str, texto: str, timestamp_mensagem: Any = None):
+    """Anexa como turno 'user', sem resposta do Gemini, uma mensagem recusada pelo limite de taxa.
+
+    Como em registrar_resposta_manual, conversas fora do cache ficam para a próxima busca na Evolution.
+    """
+    async with travas_conversa[remetente_jid]:
+        historico_conversa = cache_historico.get(remetente_jid)
+        if historico_conversa is None or remetente_jid not in ultimo_timestamp:
+            return
+        log.info("Mensagem acima do limite registrada sem resposta no histórico de %s: %s", remetente_jid, texto)
+        await anexar_turno(remetente_jid, historico_conversa, "user", texto, timestamp_mensagem)
+
 @app.post("/messages-upsert")
 async def webhook_receiver(request: Request):
-    data = await request.json()
-    
-    if data.get("event") != "messages.upsert": return {"status": "evento_ignorado"}
-    mensagem_data = data.get("data")
-    if not mensagem_data or mensagem_data.get("key", {}).get("fromMe", False): return {"status": "ignorado"}
-    remetente_jid = mensagem_data.get("key", {}).get("remoteJid")
-    if not remetente_jid or remetente_jid != TARGET_JID: return {"status": "ignorado"}
-    
-    message_obj = mensagem_data.get("message", {})
-    if "ephemeralMessage" in message_obj: message_obj = message_obj.get("ephemeralMessage", {}).get("message", {})
-
+    body = await request.body()
+    # Pré-filtro barato: se o JID alvo nem aparece nos bytes, não vale a pena decodificar o JSON
+    if TARGET_JID_BYTES not in body: return {"status": "ignorado"}
+    # Parse direto dos bytes (pydantic-core); só um upsert malformado vira 422, outros eventos são ignorados
     try:
-        conteudo_para_gemini = []
-        
-        # Busca o histórico da conversa primeiro
-        historico_conversa = await obter_historico_conversa(remetente_jid)
-        conteudo_para_gemini = historico_conversa
-        
-        # Parte da mensagem atual do usuário (pode ser texto ou áudio)
-        partes_mensagem_atual = []
-
-        if "extendedTextMessage" in message_obj or "conversation" in message_obj:
-            texto_recebido = (message_obj.get("extendedTextMessage", {}).get("text") or message_obj.get("conversation", "")).strip()
-            print(f"\n--- Mensagem de Texto Recebida de {remetente_jid} ---")
-            print(f"Mensagem: {texto_recebido}")
-            if not texto_recebido: return {"status": "ignorado_sem_conteudo_util"}
-            partes_mensagem_atual.append({'text': texto_recebido})
-
-        elif "audioMessage" in message_obj:
-            print(f"\n--- Mensagem de Áudio Recebida de {remetente_jid} ---")
-            message_id = mensagem_data.get("key", {}).get("id")
-            if not message_id:
-                print("   🚨 ERRO: Não foi possível encontrar o ID da mensagem de áudio.")
-                return {"status": "erro_sem_id"}
-
-            caminho_audio_ogg = "audio_recebido.ogg"
-            caminho_audio_mp3 = "audio_convertido.mp3"
-            
-            mp3_audio_data = None
-            try:
-                # Obter áudio decifrado da API Evolution
-                print(f"   -> Buscando áudio decifrado para a mensagem ID: {message_id}...")
-                url_get_media = f"{EVOLUTION_API_URL}/chat/getBase64FromMediaMessage/{EVOLUTION_INSTANCE_NAME}"
-                payload_get_media = {"message": {"key": {"id": message_id}}}
-                headers = {"Content-Type": "application/json", "apikey": EVOLUTION_API_KEY}
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(url_get_media, json=payload_get_media, headers=headers, timeout=60)
-                    response.raise_for_status()
-                    media_response = response.json()
-                
-                base64_audio = media_response.get("base64") 
-                if not base64_audio: raise ValueError("A resposta da API de mídia não continha a chave 'base64'.")
-                audio_data = base64.b64decode(base64_audio)
-                
-                with open(caminho_audio_ogg, "wb") as f: f.write(audio_data)
-                if os.path.getsize(caminho_audio_ogg) == 0: raise ValueError("O áudio decifrado resultou em um arquivo vazio.")
-                print(f"   -> Áudio decifrado e salvo com sucesso ({os.path.getsize(caminho_audio_ogg)} bytes).")
-
-                # Converter para MP3 com FFmpeg
-                print("   -> Convertendo áudio para .mp3 usando FFmpeg...")
-                comando_ffmpeg = ["ffmpeg", "-y", "-i", caminho_audio_ogg, "-acodec", "libmp3lame", "-b:a", "128k", caminho_audio_mp3]
-                subprocess.run(comando_ffmpeg, check=True, capture_output=True, text=True)
-                print("   -> Conversão para .mp3 concluída.")
-                
-                with open(caminho_audio_mp3, "rb") as f: mp3_audio_data = f.read()
-
-            finally:
-                if os.path.exists(caminho_audio_ogg): os.remove(caminho_audio_ogg)
-                if os.path.exists(caminho_audio_mp3): os.remove(caminho_audio_mp3)
-
-            if not mp3_audio_data:
-                await enviar_resposta_whatsapp(remetente_jid, "Desculpe, não consegui processar seu áudio desta vez.")
-                return {"status": "erro_processamento_audio"}
-
-            # Adiciona o áudio e um prompt de contexto para o Gemini
-            partes_mensagem_atual.append({'text': "Por favor, ouça este áudio e responda de acordo:"})
-            partes_mensagem_atual.append({"mime_type": "audio/mp3", "data": mp3_audio_data})
-        
-        else: # Se não for nem texto nem áudio
-            return {"status": "ignorado_sem_conteudo_util"}
+        evento = EventoWebhook.model_validate_json(body)
+        if evento.event != "messages.upsert" or evento.data is None: return {"status": "evento_ignorado"}
+        dados = UpsertData.model_validate(evento.data)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    # Formatação preguiçosa: o payload só é convertido em texto com LOG_LEVEL=DEBUG
+    log.debug("Evento recebido em /messages-upsert: %r", dados)
 
-        # Adiciona a mensagem atual (texto ou áudio) ao histórico
-        conteudo_para_gemini.append({'role': 'user', 'parts': partes_mensagem_atual})
-        
-        print("   -> Enviando contexto para o Gemini gerar resposta...")
-        resposta_gemini = model.generate_content(conteudo_para_gemini)
-        texto_resposta = resposta_gemini.text
-        print(f"   -> Resposta do Gemini: {texto_resposta}")
-
-        # Simula digitação e envia a resposta
-        tempo_de_espera = min(max(len(texto_resposta) * 0.06, 2), 8)
-        await enviar_presenca(remetente_jid, "composing")
-        await asyncio.sleep(tempo_de_espera)
-        await enviar_presenca(remetente_jid, "paused")
-        await enviar_resposta_whatsapp(remetente_jid, texto_resposta)
+    chave = dados.key
+    remetente_jid = chave.remoteJid
+    if remetente_jid != TARGET_JID: return {"status": "ignorado"}
+    if chave.fromMe:
+        # Respostas digitadas no celular entram no histórico; os ecos das mensagens do bot são descartados lá
+        texto_manual = extrair_texto(evento.data) # O mesmo extrator dos registros do findMessages
+        if chave.id is None or not texto_manual: return {"status": "ignorado"}
+        # Elas esperam pela trava do JID durante um ciclo inteiro: uma rajada de ecos também tem teto
+        if len(tarefas_registro_turnos) >= MAX_PENDING_TASKS:
+            log.warning("⚠️ Fila de registro de turnos cheia (%d tarefas); recusando eco de %s.", len(tarefas_registro_turnos), remetente_jid)
+            return JSONResponse({"status": "sobrecarregado"}, status_code=503)
+        if mensagem_ja_recebida(chave.id): return {"status": "ignorado"}
+        tarefa = asyncio.create_task(registrar_resposta_manual(remetente_jid, chave.id, texto_manual, dados.messageTimestamp))
+        tarefas_registro_turnos.add(tarefa)
+        tarefa.add_done_callback(tarefas_registro_turnos.discard)
+        return {"status": "resposta_manual_recebida"}
+    mensagem = dados.message
+    if mensagem is not None and mensagem.ephemeralMessage is not None: mensagem = mensagem.ephemeralMessage.message
+    # Com MAX_PENDING_TASKS mensagens já na fila o processo está saturado: é melhor a Evolution
+    # reenviar depois do que enfileirar mais. Vem antes do limite por JID, para não gastar token do balde,
+    # e antes da deduplicação, para que o reenvio da mensagem recusada ainda seja aceito.
+    if len(tarefas_em_andamento) >= MAX_PENDING_TASKS:
+        log.warning("⚠️ Fila de processamento cheia (%d tarefas); recusando mensagem de %s.", len(tarefas_em_andamento), remetente_jid)
+        return JSONResponse({"status": "sobrecarregado"}, status_code=503)
+    # Limite por JID (token bucket): a mensagem recusada não gera resposta, mas ainda entra no
+    # histórico, para o contexto do Gemini seguir igual à conversa real (a Evolution pode não reenviá-la)
+    if not dentro_do_limite(remetente_jid):
+        log.warning("⚠️ Limite de mensagens excedido para %s.", remetente_jid)
+        texto_limitado = extrair_texto(evento.data) or ("[Mensagem de áudio]" if mensagem is not None and mensagem.audioMessage is not None else None)
+        if texto_limitado and len(tarefas_registro_turnos) < MAX_PENDING_TASKS and (chave.id is None or not mensagem_ja_recebida(chave.id)):
+            tarefa = asyncio.create_task(registrar_mensagem_limitada(remetente_jid, texto_limitado, dados.messageTimestamp))
+            tarefas_registro_turnos.add(tarefa)
+            tarefa.add_done_callback(tarefas_registro_turnos.discard)
+        return JSONResponse({"status": "limite_excedido"}, status_code=429)
+    if chave.id is not None and mensagem_ja_recebida(chave.id): return {"status": "duplicado"}
 
-    except Exception as e:
-        print(f"   🚨 Erro no ciclo do chatbot: {e}")
-        try:
-            await enviar_resposta_whatsapp(remetente_jid, "Ocorreu um erro interno e não pude processar sua mensagem.")
-        except: pass
-        raise HTTPException(status_code=500, detail=f"Erro interno no processamento do chatbot: {e}")
-    
-    return {"status": "recebido_e_processado"}
\ No newline at end of file
+    if mensagem is None: return {"status": "ignorado_sem_conteudo_util"}
+
+    if mensagem.extendedTextMessage is not None or mensagem.conversation is not None:
+        texto_recebido = ((mensagem.extendedTextMessage and mensagem.extendedTextMessage.text) or mensagem.conversation or "").strip()
+        log.info("--- Mensagem de Texto Recebida de %s --- Mensagem: %s", remetente_jid, texto_recebido)
+        if not texto_recebido: return {"status": "ignorado_sem_conteudo_util"}
+        tarefa = asyncio.create_task(processar_mensagem(remetente_jid, chave.id, texto_recebido=texto_recebido, timestamp_mensagem=dados.messageTimestamp))
+
+    elif mensagem.audioMessage is not None and chave.id is not None: # O id é necessário para baixar o áudio
+        log.info("--- Mensagem de Áudio Recebida de %s ---", remetente_jid)
+        tarefa = asyncio.create_task(processar_mensagem(remetente_jid, chave.id, timestamp_mensagem=dados.messageTimestamp))
+
+    else: # Se não for nem texto nem áudio
+        return {"status": "ignorado_sem_conteudo_util"}
+
+    # Responde ao webhook imediatamente; o processamento pesado segue em segundo plano
+    tarefas_em_andamento.add(tarefa)
+    tarefa.add_done_callback(tarefas_em_andamento.discard)
+    return {"status": "recebido_e_enfileirado"}